@@ -18,6 +18,10 @@
 ###############################################################################
 
 import json
+import re
+import threading
+import time
+import zlib
 from datetime import datetime
 
 from bson.objectid import ObjectId
@@ -156,8 +160,48 @@ def tearDownModule():
     base.stopServer()
 
 
+def names(results):
+    return [str(i['name']) for i in results]
+
+
+def winningStages(explain):
+    """Return the stage names of the winning plans in an explain output."""
+    stages = []
+
+    def walk(node, inPlan):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'rejectedPlans':
+                    continue
+                if inPlan and key == 'stage':
+                    stages.append(value)
+                walk(value, inPlan or key == 'winningPlan')
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, inPlan)
+
+    walk(explain, False)
+    return stages
+
+
 class GritsSearchTestCase(base.TestCase):
 
+    def search(self, user=None, **params):
+        """Run a search, by default as the admin, and return the results."""
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params=params,
+            user=user or self.admin
+        )
+        self.assertStatusOk(resp)
+        if isinstance(resp.json, list):
+            for i in resp.json:
+                self.assertNotHasKeys(
+                    i, ['diagnosisNames', 'diagnosisKeywords']
+                )
+        return resp.json
+
     def setUpGroups(self):
         self.admin = self.model('user').createUser(**admin)
         self.normalUser = self.model('user').createUser(**normalUser)
@@ -368,3 +412,792 @@ class GritsSearchTestCase(base.TestCase):
 
         results = resp.json
         self.assertEqual(len(results), 2)
+
+    def testBatchSearch(self):
+
+        self.setUpData()
+
+        gritsGroup = self.model('group').find({'name': 'GRITS'})[0]
+        g = self.model('user').createUser(**gritsUser)
+        self.model('group').addUser(gritsGroup, g)
+
+        specs = [
+            {},
+            {'country': 'country2'},
+            {'diagnosis': 'flu', 'regex': 1, 'geoJSON': 1},
+            {'start': 'not a date'}
+        ]
+
+        resp = self.request(
+            path='/resource/grits/batch',
+            method='POST',
+            user=self.normalUser,
+            body=json.dumps(specs),
+            type='application/json'
+        )
+        self.assertStatus(resp, 403)
+
+        resp = self.request(
+            path='/resource/grits/batch',
+            method='POST',
+            user=g,
+            body=json.dumps(specs),
+            type='application/json'
+        )
+        self.assertStatusOk(resp)
+
+        results = resp.json
+        self.assertEqual(len(results), len(specs))
+        self.assertEqual(len(results[0]['result']), len(incidents))
+        for i in results[0]['result']:
+            self.assertNotHasKeys(i, ['private'])
+        self.assertEqual(
+            sorted(str(i['name']) for i in results[1]['result']),
+            ['1001', '1002']
+        )
+        self.assertEqual(len(results[2]['result']['features']), 2)
+        self.assertEqual(results[3]['code'], 400)
+        self.assertNotHasKeys(results[3], ['result'])
+
+        resp = self.request(
+            path='/resource/grits/batch',
+            method='POST',
+            user=g,
+            body=json.dumps({'country': 'country2'}),
+            type='application/json'
+        )
+        self.assertStatus(resp, 400)
+
+    def testFacetedSearch(self):
+
+        self.setUpData()
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'facets': 'country,disease,feed',
+                'limit': 1
+            },
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+
+        self.assertEqual(len(resp.json['results']), 1)
+        self.assertEqual(str(resp.json['results'][0]['name']), '1000')
+        facets = resp.json['facets']
+        self.assertEqual(
+            facets['country'],
+            [
+                {'value': 'country2', 'count': 2},
+                {'value': 'country1', 'count': 1}
+            ]
+        )
+        self.assertEqual(facets['disease'][0], {
+            'value': 'disease 1', 'count': 2
+        })
+        self.assertEqual(len(facets['feed']), 2)
+        self.assertNotHasKeys(facets, ['species'])
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'facets': 'country',
+                'facetLimit': 1,
+                'feed': 'feed 1',
+                'geoJSON': 1
+            },
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['results']['features']), 2)
+        self.assertEqual(len(resp.json['facets']['country']), 1)
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'facets': 'name'
+            },
+            user=self.admin
+        )
+        self.assertStatus(resp, 400)
+
+        # non numeric parameters are client errors
+        for params in (
+                {'facets': 'country', 'facetLimit': 'ten'},
+                {'sample': 'x'},
+                {'partitions': 'x'},
+                {'maxTimeMS': 'x'}
+        ):
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params=params,
+                user=self.admin
+            )
+            self.assertStatus(resp, 400)
+
+    def testTextSearch(self):
+
+        self.setUpData()
+
+        ranked = names(self.search(text='descriptions 3'))
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual(ranked[0], '1002')
+
+        self.assertEqual(self.search(text='3', country='country1'), [])
+        self.assertEqual(
+            names(self.search(text='2', start='2012-02-01')), ['1001']
+        )
+        self.assertEqual(self.search(text='unmatched'), [])
+
+        # filters are applied before the candidates are cut, so removing
+        # the best ranked incidents still returns the remaining ones
+        from girder.plugins.gritsSearch import config
+        batch = config['textCandidateBatch']
+        config['textCandidateBatch'] = 1
+        try:
+            self.assertEqual(names(self.search(
+                text='descriptions 3', country='country1'
+            )), ['1000'])
+            self.assertEqual(names(self.search(
+                text='descriptions 3', feed='feed 1', limit=1
+            )), [ranked[1]])
+            self.assertEqual(names(self.search(
+                text='descriptions 3', offset=1, limit=1
+            )), [ranked[1]])
+        finally:
+            config['textCandidateBatch'] = batch
+
+        # the index follows item updates
+        item = self.model('item').find({'name': '1000'})[0]
+        item['description'] = 'cholera outbreak'
+        self.model('item').save(item)
+        self.assertEqual(names(self.search(text='outbreaks')), ['1000'])
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'text': 'description',
+                'facets': 'country'
+            },
+            user=self.admin
+        )
+        self.assertStatus(resp, 400)
+
+    def testSuggest(self):
+
+        self.setUpData()
+
+        def suggest(user=None, **params):
+            resp = self.request(
+                path='/resource/grits/suggest',
+                method='GET',
+                params=params,
+                user=user or self.admin
+            )
+            self.assertStatusOk(resp)
+            return [(i['value'], i['count']) for i in resp.json]
+
+        self.assertEqual(
+            suggest(field='country', prefix='COUN'),
+            [('country2', 2), ('country1', 1)]
+        )
+        self.assertEqual(
+            suggest(field='country', prefix='coun', limit=1),
+            [('country2', 2)]
+        )
+        self.assertEqual(
+            suggest(field='diagnosis', prefix='in'),
+            [('Influenza', 1)]
+        )
+        self.assertEqual(suggest(field='feed', prefix='x'), [])
+
+        # the index follows item updates
+        item = self.model('item').find({'name': '1000'})[0]
+        self.model('item').setMetadata(item, {'country': 'Chile'})
+        self.assertEqual(
+            suggest(field='country', prefix='c'),
+            [('country2', 2), ('Chile', 1)]
+        )
+
+        # item events during a build are buffered and replayed afterwards
+        from girder import events
+        from girder.plugins.gritsSearch import (
+            GRITSDatabase, SuggestIndex, suggestFields
+        )
+        db = GRITSDatabase()
+        folderId = item['folderId']
+        pending = []
+
+        def create():
+            item = self.model('item').find({'name': '1001'})[0]
+            self.model('item').setMetadata(item, {'country': 'Peru'})
+            db.onItemSave(events.Event('model.item.save.after', item))
+            pending.extend(db._pendingIds['suggest'])
+            return SuggestIndex(suggestFields)
+
+        index = db.buildIndex(
+            'suggest', folderId, create, {'folderId': folderId}
+        )
+        updated = self.model('item').find({'name': '1001'})[0]
+        self.assertEqual(pending, [updated['_id']])
+        self.assertEqual(index.suggest('country', 'p'), [('Peru', 1)])
+        self.assertEqual(db._pendingIds, {})
+
+        for params in ({'field': 'link', 'prefix': 'www'},
+                       {'field': 'country', 'prefix': 'c', 'limit': 'x'}):
+            resp = self.request(
+                path='/resource/grits/suggest',
+                method='GET',
+                params=params,
+                user=self.admin
+            )
+            self.assertStatus(resp, 400)
+
+        resp = self.request(
+            path='/resource/grits/suggest',
+            method='GET',
+            params={'field': 'country', 'prefix': 'c'},
+            user=self.normalUser
+        )
+        self.assertStatus(resp, 403)
+
+    def testQueryCostGuard(self):
+        from girder.plugins.gritsSearch import (
+            AdmissionGate, isExpensiveQuery
+        )
+
+        wide = {'$gte': datetime(1990, 1, 1), '$lt': datetime(2015, 1, 1)}
+        narrow = {'$gte': datetime(2014, 1, 1), '$lt': datetime(2014, 2, 1)}
+        self.assertTrue(isExpensiveQuery({
+            'meta.date': wide,
+            'meta.country': re.compile('land')
+        }))
+        self.assertTrue(isExpensiveQuery({
+            'meta.date': wide,
+            'meta.diagnosis.diseases': {'$elemMatch': {
+                'name': re.compile('flu')
+            }}
+        }))
+        self.assertFalse(isExpensiveQuery({
+            'meta.date': wide,
+            'meta.country': re.compile('^Ch')
+        }))
+        self.assertFalse(isExpensiveQuery({
+            'meta.date': narrow,
+            'meta.country': re.compile('land')
+        }))
+        self.assertFalse(isExpensiveQuery({
+            'meta.date': wide,
+            'meta.country': re.compile('land'),
+            'name': '1000'
+        }))
+        self.assertFalse(isExpensiveQuery({
+            'meta.date': wide,
+            'meta.country': 'Chile'
+        }))
+
+        gate = AdmissionGate(1)
+        self.assertTrue(gate.acquire(0))
+        self.assertFalse(gate.acquire(0.01))
+        gate.release()
+        self.assertTrue(gate.acquire(0))
+        gate.release()
+
+        self.setUpData()
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'limit': 0,
+                'country': 'country',
+                'regex': 1,
+                'maxTimeMS': 10000
+            },
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), len(incidents))
+
+        # a timezone aware start combined with the default naive end
+        for start in ('2012-01-15T00:00:00Z', '1990-01-01T00:00:00Z'):
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params={'start': start, 'country': 'country', 'regex': 1},
+                user=self.admin
+            )
+            self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), len(incidents))
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={
+                'start': '2012-02-01T01:00:00+02:00',
+                'end': '2012-02-05'
+            },
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual([str(i['name']) for i in resp.json], ['1001'])
+
+    def testDiagnosisKeywordSearch(self):
+        from girder.plugins.gritsSearch import GRITSDatabase
+
+        self.setUpData()
+
+        self.assertEqual(
+            sorted(names(self.search(diagnosisKeyword='flu'))),
+            ['1001', '1002']
+        )
+        self.assertEqual(
+            names(self.search(diagnosis='Influenza ')), ['1002']
+        )
+        self.assertEqual(
+            names(self.search(diagnosis='^INF', regex=1)), ['1002']
+        )
+        self.assertEqual(self.search(diagnosisKeyword='flue'), [])
+
+        # simulate items and indexes from before the upgrade
+        collection = self.model('item').collection
+        indexes = [
+            [('folderId', 1), ('meta.date', 1), ('_id', 1)],
+            [('folderId', 1), ('diagnosisNames', 1), ('meta.date', 1),
+             ('_id', 1)],
+            [('folderId', 1), ('diagnosisKeywords', 1), ('meta.date', 1),
+             ('_id', 1)]
+        ]
+
+        def downgrade():
+            for index in indexes:
+                collection.drop_index(index)
+                # the indexes created before ids broke date ties
+                collection.create_index(index[:-1])
+            collection.update(
+                {},
+                {'$unset': {'diagnosisNames': 1, 'diagnosisKeywords': 1}},
+                multi=True
+            )
+
+        def checkUpgraded():
+            keys = [
+                i['key'] for i in collection.index_information().values()
+            ]
+            for index in indexes:
+                self.assertIn(index, keys)
+                self.assertNotIn(index[:-1], keys)
+            item = collection.find_one({'name': '1002'})
+            self.assertEqual(item['diagnosisNames'], ['influenza'])
+            self.assertEqual(item['diagnosisKeywords'], ['flu'])
+            item = collection.find_one({'name': '1000'})
+            self.assertEqual(item['diagnosisNames'], [])
+
+        # the folder already exists when the plugin loads
+        downgrade()
+        GRITSDatabase().warmUp()
+        checkUpgraded()
+
+        # the folder id is known before the first request
+        downgrade()
+        db = GRITSDatabase()
+        db.knownFolderId()
+        db.gritsInfo()
+        checkUpgraded()
+
+    def testQueryPlans(self):
+        from girder.plugins.gritsSearch import GRITSDatabase, readCollection
+
+        self.setUpData()
+        db = GRITSDatabase()
+        folder = {'_id': db.gritsInfo()['folder']['_id']}
+        collection = readCollection(primary=True)
+
+        # pages are read in index order and stop after limit entries
+        for params in ({}, {'sortdir': -1}, {'diagnosis': 'influenza'}):
+            options = db.getSearchOptions(params, True)
+            stages = winningStages(collection.find(
+                db.buildQuery(params, folder),
+                limit=options['limit'],
+                sort=options['sort']
+            ).explain())
+            self.assertIn('IXSCAN', stages)
+            self.assertNotIn('SORT', stages)
+
+        # samples read only the ids, which the folder index covers
+        explain = collection.database.command(
+            'aggregate', collection.name, explain=True, pipeline=[
+                {'$match': db.buildQuery({}, folder)},
+                {'$project': {'_id': 1}},
+                {'$sample': {'size': 2}}
+            ]
+        )
+        stages = winningStages(explain)
+        self.assertIn('IXSCAN', stages)
+        self.assertNotIn('FETCH', stages)
+
+    def testReadPreference(self):
+        from girder.plugins.gritsSearch import config, readCollection
+
+        collection = readCollection()
+        if hasattr(collection, 'with_options'):
+            self.assertEqual(
+                collection.read_preference.mongos_mode,
+                config['readPreference']
+            )
+            self.assertEqual(
+                readCollection(primary=True).read_preference.mongos_mode,
+                'primary'
+            )
+
+        self.setUpData()
+
+        gritsGroup = self.model('group').find({'name': 'GRITS'})[0]
+        g = self.model('user').createUser(**gritsUser)
+        self.model('group').addUser(gritsGroup, g)
+
+        for user in (self.admin, g):
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params={'readPrimary': 1, 'feed': 'feed 1'},
+                user=user
+            )
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json), 2)
+
+    def testSampledSearch(self):
+
+        self.setUpData()
+
+        gritsGroup = self.model('group').find({'name': 'GRITS'})[0]
+        g = self.model('user').createUser(**gritsUser)
+        self.model('group').addUser(gritsGroup, g)
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={'sample': 2, 'feed': 'feed 1'},
+            user=g
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['total'], 2)
+        self.assertEqual(
+            sorted(str(i['name']) for i in resp.json['results']),
+            ['1000', '1001']
+        )
+        for i in resp.json['results']:
+            self.assertNotHasKeys(i, ['private'])
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={'sample': 1, 'geoJSON': 1},
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['total'], len(incidents))
+        self.assertEqual(len(resp.json['results']['features']), 1)
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={'sample': 1, 'country': 'nowhere'},
+            user=self.admin
+        )
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'results': [], 'total': 0})
+
+        # a count that times out falls back to the folder and date count
+        from pymongo.errors import ExecutionTimeout
+        import girder.plugins.gritsSearch as plugin
+        countDocuments = plugin.countDocuments
+
+        def slowCount(collection, query, maxTimeMS=None):
+            if maxTimeMS is not None:
+                raise ExecutionTimeout('timed out')
+            return countDocuments(collection, query)
+
+        plugin.countDocuments = slowCount
+        try:
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params={'sample': 1, 'feed': 'feed 1'},
+                user=self.admin
+            )
+        finally:
+            plugin.countDocuments = countDocuments
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['total'], len(incidents))
+        self.assertTrue(resp.json['totalEstimated'])
+        self.assertEqual(len(resp.json['results']), 1)
+
+        for params in ({'sample': 0}, {'sample': 1, 'facets': 'country'}):
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params=params,
+                user=self.admin
+            )
+            self.assertStatus(resp, 400)
+
+    def testCompressedSearch(self):
+        from girder.plugins.gritsSearch import (
+            config, negotiateEncoding, GRITSDatabase, ResponseCache
+        )
+
+        self.assertEqual(negotiateEncoding('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiateEncoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiateEncoding('br'), None)
+
+        # responses computed before a clear are not cached
+        cache = ResponseCache(1024, 60)
+        generation = cache.generation
+        cache.clear()
+        cache.put('key', b'stale', generation)
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', b'fresh', cache.generation)
+        self.assertEqual(cache.get('key'), b'fresh')
+
+        # secondary reads are cached no longer than the staleness bound
+        self.assertEqual(
+            GRITSDatabase()._responseCache.ttl,
+            min(config['responseCacheSeconds'], config['maxStalenessSeconds'])
+        )
+        preference = config['readPreference']
+        config['readPreference'] = 'primary'
+        try:
+            self.assertEqual(
+                GRITSDatabase()._responseCache.ttl,
+                config['responseCacheSeconds']
+            )
+        finally:
+            config['readPreference'] = preference
+
+        self.setUpData()
+
+        def search(encoding, params=None):
+            resp = self.request(
+                path='/resource/grits',
+                method='GET',
+                params=params or {'geoJSON': 1},
+                user=self.admin,
+                isJson=False,
+                additionalHeaders=[('Accept-Encoding', encoding)]
+            )
+            self.assertStatusOk(resp)
+            return resp, self.getBody(resp, text=False)
+
+        threshold = config['compressionThreshold']
+        config['compressionThreshold'] = 100
+        try:
+            resp, body = search('gzip')
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            features = json.loads(
+                zlib.decompress(body, 16 + zlib.MAX_WBITS).decode('utf8')
+            )['features']
+            self.assertEqual(len(features), len(incidents))
+
+            # a cached response returns the same bytes
+            resp, cached = search('gzip')
+            self.assertEqual(cached, body)
+
+            resp, body = search('deflate')
+            self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+            features = json.loads(
+                zlib.decompress(body).decode('utf8')
+            )['features']
+            self.assertEqual(len(features), len(incidents))
+
+            # compressed and plain responses encode dates the same way
+            resp, body = search('gzip', {'limit': 100})
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(
+                zlib.decompress(body, 16 + zlib.MAX_WBITS).decode('utf8')
+            ), self.search(limit=100))
+
+            # small responses are not compressed
+            resp, body = search('gzip', {'country': 'nowhere'})
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(json.loads(body.decode('utf8')), [])
+        finally:
+            config['compressionThreshold'] = threshold
+
+    def testPartitionedSearch(self):
+
+        self.setUpData()
+
+        for params in (
+                {},
+                {'sortdir': -1},
+                {'offset': 1, 'limit': 1},
+                {'sort': 'name', 'sortdir': -1, 'limit': 2},
+                {'offset': 2, 'limit': 1, 'sortdir': -1},
+                {'feed': 'feed 1', 'start': '2011-06-01', 'end': '2012-06-01'},
+                # timezone aware bounds are planned in naive UTC
+                {'start': '2011-06-01T00:00:00Z',
+                 'end': '2012-06-01T00:00:00+02:00'}
+        ):
+            expected = names(self.search(**params))
+            for partitions in (1, 2, 3, 8):
+                self.assertEqual(
+                    names(self.search(partitions=partitions, **params)),
+                    expected
+                )
+
+        self.assertEqual(
+            names(self.search(partitions=4, sortdir=-1, limit=2)),
+            ['1002', '1001']
+        )
+
+        # the partitions are queried concurrently
+        import girder.plugins.gritsSearch as plugin
+        readCollection = plugin.readCollection
+        lock = threading.Lock()
+        running = [0, 0]
+
+        class SlowCollection(object):
+            def __init__(self, collection):
+                self.collection = collection
+
+            def __getattr__(self, name):
+                return getattr(self.collection, name)
+
+            def find(self, *args, **kwargs):
+                if 'limit' in kwargs:
+                    with lock:
+                        running[0] += 1
+                        running[1] = max(running)
+                    time.sleep(0.2)
+                    with lock:
+                        running[0] -= 1
+                return self.collection.find(*args, **kwargs)
+
+        plugin.readCollection = lambda *args: SlowCollection(
+            readCollection(*args)
+        )
+        try:
+            for params in ({}, {'sort': 'name'}):
+                self.assertEqual(
+                    names(self.search(partitions=3, **params)),
+                    names(self.search(**params))
+                )
+                self.assertGreater(running[1], 1)
+                running[1] = 0
+        finally:
+            plugin.readCollection = readCollection
+
+        resp = self.request(
+            path='/resource/grits',
+            method='GET',
+            params={'partitions': 100},
+            user=self.admin
+        )
+        self.assertStatus(resp, 400)
+
+    def testHotWindowSearch(self):
+        from girder.plugins.gritsSearch import config
+
+        days = config['hotWindowDays']
+        config['hotWindowDays'] = 365 * 100
+        try:
+            self.setUpData()
+
+            for params in (
+                    {},
+                    {'sortdir': -1, 'limit': 2},
+                    {'offset': 1},
+                    {'country': 'country2', 'disease': 'disease 1'},
+                    {'country': '^country', 'feed': '2$', 'regex': 1},
+                    {'country': 'nowhere'},
+                    {'start': '2012-01-15', 'end': '2012-02-03'},
+                    {'geoJSON': 1}
+            ):
+                # readPrimary searches always go to the database
+                expected = self.search(readPrimary=1, **params)
+                self.assertEqual(self.search(**params), expected)
+
+            self.assertEqual(
+                names(self.search(feed='feed 1')), ['1000', '1001']
+            )
+
+            # pages are read according to the read preference and only the
+            # items a lagging secondary has not seen come from the primary
+            import girder.plugins.gritsSearch as plugin
+            readCollection = plugin.readCollection
+            latest = self.model('item').find({'name': '1002'})[0]['_id']
+            reads = []
+
+            class LaggingCollection(object):
+                def __init__(self, collection, primary):
+                    self.collection = collection
+                    self.primary = primary
+
+                def __getattr__(self, name):
+                    return getattr(self.collection, name)
+
+                def find(self, query, *args, **kwargs):
+                    if '_id' in query:
+                        ids = query['_id']['$in']
+                        reads.append((self.primary, len(ids)))
+                        if not self.primary:
+                            query = {'_id': {
+                                '$in': [i for i in ids if i != latest]
+                            }}
+                    return self.collection.find(query, *args, **kwargs)
+
+            plugin.readCollection = lambda primary=False: LaggingCollection(
+                readCollection(primary), primary
+            )
+            try:
+                self.assertEqual(
+                    sorted(names(self.search())),
+                    sorted(i['name'] for i in incidents)
+                )
+            finally:
+                plugin.readCollection = readCollection
+            self.assertEqual(reads, [(False, len(incidents)), (True, 1)])
+
+            # incidents on the same date are ordered by id in both stores
+            others = self.model('item').find({'name': {'$ne': '1000'}})
+            for item in list(others):
+                self.model('item').setMetadata(
+                    item, {'date': incidents[0]['meta']['date']}
+                )
+            for params in ({}, {'sortdir': -1}, {'offset': 1, 'limit': 1}):
+                self.assertEqual(
+                    self.search(**params),
+                    self.search(readPrimary=1, **params)
+                )
+
+            # items saved with aware dates are held in UTC like mongo does
+            from dateutil.tz import tzoffset
+            item = self.model('item').find({'name': '1002'})[0]
+            self.model('item').setMetadata(item, {
+                'date': datetime(2012, 1, 1, 1, tzinfo=tzoffset(None, 7200))
+            })
+            hour = {'start': '2011-12-31T23:00:00Z',
+                    'end': '2011-12-31T23:00:01Z'}
+            self.assertEqual(names(self.search(**hour)), ['1002'])
+            for params in ({}, hour):
+                self.assertEqual(
+                    self.search(**params),
+                    self.search(readPrimary=1, **params)
+                )
+
+            # the window follows item updates and removals
+            item = self.model('item').find({'name': '1000'})[0]
+            self.model('item').setMetadata(item, {'feed': 'feed 2'})
+            self.assertEqual(names(self.search(feed='feed 1')), ['1001'])
+            item = self.model('item').find({'name': '1001'})[0]
+            self.model('item').remove(item)
+            self.assertEqual(self.search(feed='feed 1'), [])
+            self.assertEqual(len(self.search()), len(incidents) - 1)
+        finally:
+            config['hotWindowDays'] = days
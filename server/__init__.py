@@ -3,19 +3,36 @@ import os
 import re
 import random
 from dateutil.parser import parse as dateParse
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
 
 import json
 import bson.json_util
+from bson.son import SON
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
 
 import cherrypy
+from pymongo import read_preferences
+from pymongo.errors import ExecutionTimeout
 
+from girder import events
 from girder.api.rest import Resource, RestException, loadmodel
 from girder.api.describe import Description
+from girder.utility import JsonEncoder
 from girder.utility.model_importer import ModelImporter
 from girder.constants import AccessType
 from girder.models.model_base import AccessException
 
+from .compression import (
+    ResponseCache, compressChunks, negotiateEncoding, toBytes
+)
+from .hotwindow import HotWindow, naiveUTC, numpy
+from .partition import mergeSorted, splitRange
+from .suggest import SuggestIndex
+from .textindex import TextIndex
+
 try:
     from girder.api import access
 except ImportError:
@@ -29,7 +46,53 @@ config = {
     'folderName': 'allAlerts',
     'user': 'grits',
     'group': 'GRITS',
-    'groupPriv': 'GRITSPriv'
+    'groupPriv': 'GRITSPriv',
+    'batchThreads': 4,
+    'batchMaxQueries': 32,
+    'facetLimit': 10,
+    'textCandidateBatch': 1000,
+    'maxLimit': {'priv': 10000, 'user': 1000},
+    'maxTimeMS': {'priv': 60000, 'user': 20000},
+    'expensiveRangeDays': 365,
+    'expensiveQuerySlots': 2,
+    'expensiveQueueTimeout': 5,
+    'readPreference': 'secondaryPreferred',
+    'maxStalenessSeconds': 90,
+    'compressionLevel': 6,
+    'compressionThreshold': 1024,
+    'responseCacheBytes': 64 * 1024 * 1024,
+    'responseCacheSeconds': 300,
+    'maxPartitions': 8,
+    'partitionOversample': 4,
+    'partitionThreads': 8,
+    'hotWindowDays': 90,
+    'hotWindowMaxRows': 1000000
+}
+
+facetFields = {
+    'country': 'meta.country',
+    'disease': 'meta.disease',
+    'feed': 'meta.feed',
+    'species': 'meta.species'
+}
+
+hotWindowKeys = set(
+    ['folderId', 'meta.date'] + ['meta.' + f for f in HotWindow.fields]
+)
+
+suggestFields = {
+    'country': 'meta.country',
+    'disease': 'meta.disease',
+    'species': 'meta.species',
+    'feed': 'meta.feed',
+    'diagnosis': 'meta.diagnosis.diseases.name'
+}
+
+# the fields read to build each in-memory index
+indexFields = {
+    'text': ['description', 'meta.description'],
+    'suggest': list(suggestFields.values()),
+    'hotWindow': ['meta.' + f for f in HotWindow.fields + ('date',)]
 }
 
 
@@ -42,6 +105,84 @@ def findOne(model, query):
     return item
 
 
+def getIntParam(params, key, default=None):
+    value = params.get(key, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RestException('%s must be an integer.' % key)
+
+
+def aggregate(collection, pipeline, **kwargs):
+    result = collection.aggregate(pipeline, **kwargs)
+    # older pymongo versions return the raw command response
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+
+def readCollection(primary=False):
+    """Return the item collection configured with the read preference of the
+    plugin's read-only routes."""
+    collection = ModelImporter().model('item').collection
+    mode = 'primary' if primary else config['readPreference']
+    # pymongo < 3 only supports read preferences on the client
+    if mode == 'primary' or not hasattr(collection, 'with_options'):
+        return collection
+    cls = {
+        'primaryPreferred': read_preferences.PrimaryPreferred,
+        'secondary': read_preferences.Secondary,
+        'secondaryPreferred': read_preferences.SecondaryPreferred,
+        'nearest': read_preferences.Nearest
+    }[mode]
+    try:
+        preference = cls(max_staleness=config['maxStalenessSeconds'] or -1)
+    except TypeError:
+        # max_staleness was added in pymongo 3.4
+        preference = cls()
+    return collection.with_options(read_preference=preference)
+
+
+def countDocuments(collection, query, maxTimeMS=None):
+    if hasattr(collection, 'count_documents'):
+        if maxTimeMS is None:
+            return collection.count_documents(query)
+        return collection.count_documents(query, maxTimeMS=maxTimeMS)
+    cursor = collection.find(query)
+    if maxTimeMS is not None:
+        cursor = cursor.max_time_ms(maxTimeMS)
+    return cursor.count()
+
+
+def updateOne(collection, query, update):
+    if hasattr(collection, 'update_one'):
+        return collection.update_one(query, update)
+    return collection.update(query, update)
+
+
+def normalizeTerm(value):
+    return ' '.join(value.lower().split())
+
+
+def diagnosisTerms(item):
+    """Return the normalized disease and keyword names of the differential
+    diagnosis of an incident."""
+    meta = item.get('meta') or {}
+    diseases = (meta.get('diagnosis') or {}).get('diseases') or []
+    names = set()
+    keywords = set()
+    for disease in diseases:
+        if not isinstance(disease, dict):
+            continue
+        if hasattr(disease.get('name'), 'lower'):
+            names.add(normalizeTerm(disease['name']))
+        for keyword in disease.get('keywords') or []:
+            if isinstance(keyword, dict) and \
+                    hasattr(keyword.get('name'), 'lower'):
+                keywords.add(normalizeTerm(keyword['name']))
+    return sorted(names), sorted(keywords)
+
+
 def getInfo():
     info = {}
     userModel = ModelImporter().model('user')
@@ -131,6 +272,52 @@ def getInfo():
     return info
 
 
+def isUnanchoredRegex(value):
+    if isinstance(value, dict):
+        return any(isUnanchoredRegex(v) for v in value.values())
+    return hasattr(value, 'pattern') and not value.pattern.startswith('^')
+
+
+def isExpensiveQuery(query):
+    """Flag searches that scan a wide date range with an unanchored regex
+    and no other index backed predicate to narrow them down."""
+    if '_id' in query:
+        return False
+    if 'name' in query and not hasattr(query['name'], 'pattern'):
+        # exact incident ids are looked up through the name index
+        return False
+    dates = query['meta.date']
+    if naiveUTC(dates['$lt']) - naiveUTC(dates['$gte']) < \
+            timedelta(days=config['expensiveRangeDays']):
+        return False
+    return any(isUnanchoredRegex(v) for v in query.values())
+
+
+class AdmissionGate(object):
+    """A counting semaphore whose acquire gives up after a timeout."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._active >= self.slots:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self._active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+
 def commonErrors(desc):
     desc.description.errorResponse('Permission denied', 403)
     desc.description.errorResponse('"grits" user does not exist', 405)
@@ -141,19 +328,216 @@ class GRITSDatabase(Resource):
         self._symptomsTable = None
         self._gritsFolder = None
         self._info = None
+        self._folderId = None
+        self._preparedFolders = set()
+        self._prepareLock = threading.Lock()
+        self._pools = {}
+        self._poolLock = threading.Lock()
+        self._indexes = dict((name, None) for name in indexFields)
+        self._indexLocks = dict(
+            (name, threading.Lock()) for name in indexFields
+        )
+        # ids of the items changed while an index is being built
+        self._pendingIds = {}
+        self._pendingLock = threading.Lock()
+        self._expensiveGate = AdmissionGate(config['expensiveQuerySlots'])
+        # a response read from a lagging secondary after an item update
+        # must not outlive the staleness the read preference allows
+        ttl = config['responseCacheSeconds']
+        if config['readPreference'] != 'primary' and \
+                config['maxStalenessSeconds']:
+            ttl = min(ttl, config['maxStalenessSeconds'])
+        self._responseCache = ResponseCache(config['responseCacheBytes'], ttl)
 
     def gritsInfo(self):
         # if self._info is None:
         #     self._info = getInfo()
         # return self._info
-        return getInfo()
+        info = getInfo()
+        folderId = info['folder']['_id']
+        self.ensurePrepared(folderId)
+        if folderId != self._folderId:
+            # the folder was (re)created, so the in-memory indexes are stale
+            self.resetIndexes()
+            self._folderId = folderId
+        return info
+
+    def warmUp(self):
+        """Prepare the folder and build the in-memory indexes at load when
+        the folder already exists."""
+        folderId = self.knownFolderId()
+        if folderId is not None:
+            self.ensurePrepared(folderId)
+            self.getSuggestIndex(folderId)
+            self.getHotWindow(folderId)
 
     def gritsFolder(self):
         return self.gritsInfo()['folder']
 
-    def checkAccess(self, level=AccessType.READ, priv=False, fail=True):
-        g = self.gritsInfo()['group']
-        p = self.gritsInfo()['groupPriv']
+    def resetIndexes(self):
+        for name in indexFields:
+            with self._indexLocks[name]:
+                self._indexes[name] = None
+        self._responseCache.clear()
+
+    @staticmethod
+    def prepareFolder(folderId):
+        """Create the plugin's indexes and backfill the diagnosis fields
+        maintained by onItemBeforeSave."""
+        collection = ModelImporter().model('item').collection
+        # searches sort by date then id, so the id completes every index
+        # and pages stop after limit index entries without a sort stage
+        existing = [
+            i['key'] for i in collection.index_information().values()
+        ]
+        for prefix in ([], ['diagnosisNames'], ['diagnosisKeywords']):
+            keys = [('folderId', 1)] + [(k, 1) for k in prefix] + \
+                [('meta.date', 1)]
+            collection.create_index(keys + [('_id', 1)])
+            # superseded by the index above
+            if keys in existing:
+                collection.drop_index(keys)
+        cursor = collection.find(
+            {'folderId': folderId, 'diagnosisNames': {'$exists': False}},
+            {'meta.diagnosis': 1}
+        )
+        for item in cursor:
+            names, keywords = diagnosisTerms(item)
+            updateOne(collection, {'_id': item['_id']}, {'$set': {
+                'diagnosisNames': names,
+                'diagnosisKeywords': keywords
+            }})
+
+    def ensurePrepared(self, folderId):
+        # run once per folder, whichever of load or a request gets there
+        # first, without racing concurrent first requests
+        if folderId in self._preparedFolders:
+            return
+        with self._prepareLock:
+            if folderId not in self._preparedFolders:
+                self.prepareFolder(folderId)
+                self._preparedFolders.add(folderId)
+
+    def knownFolderId(self):
+        # look up the folder without creating anything so that it is safe
+        # to call from model event handlers
+        if self._folderId is None:
+            collection = findOne(
+                ModelImporter().model('collection'),
+                {'name': config['collectionName']}
+            )
+            if collection is not None:
+                folder = findOne(
+                    ModelImporter().model('folder'),
+                    {
+                        'name': config['folderName'],
+                        'parentId': collection['_id']
+                    }
+                )
+                if folder is not None:
+                    self._folderId = folder['_id']
+        return self._folderId
+
+    def isGritsItem(self, item):
+        folderId = self.knownFolderId()
+        return folderId is not None and item.get('folderId') == folderId
+
+    def onItemBeforeSave(self, event):
+        item = event.info
+        if self.isGritsItem(item):
+            item['diagnosisNames'], item['diagnosisKeywords'] = \
+                diagnosisTerms(item)
+
+    def onItemSave(self, event):
+        item = event.info
+        isGrits = self.isGritsItem(item)
+        if isGrits:
+            self._responseCache.clear()
+        self.indexEvent(item['_id'], item if isGrits else None)
+
+    def onItemRemove(self, event):
+        item = event.info
+        if self.isGritsItem(item):
+            self._responseCache.clear()
+        self.indexEvent(item['_id'], None)
+
+    @classmethod
+    def updateIndex(cls, name, index, itemId, item):
+        """Apply the state of an item to an in-memory index; ``item`` is None
+        when the item was removed or is not in the GRITS folder."""
+        if item is None:
+            index.remove(itemId)
+        elif name == 'text':
+            index.add(itemId, cls.itemText(item))
+        elif name == 'suggest':
+            index.update(itemId, cls.suggestValues(item))
+        else:
+            index.add(itemId, item.get('meta', {}))
+
+    def indexEvent(self, itemId, item):
+        for name in indexFields:
+            with self._pendingLock:
+                index = self._indexes[name]
+                if index is None:
+                    if name in self._pendingIds:
+                        self._pendingIds[name].add(itemId)
+                    continue
+            self.updateIndex(name, index, itemId, item)
+
+    def buildIndex(self, name, folderId, create, query):
+        """Fill a new in-memory index from the primary and publish it.
+
+        Item events that arrive during the build are buffered and replayed
+        from the primary once the index is published.
+        """
+        with self._indexLocks[name]:
+            if self._indexes[name] is not None:
+                return self._indexes[name]
+            with self._pendingLock:
+                self._pendingIds[name] = set()
+            index = create()
+            collection = readCollection(primary=True)
+            try:
+                for item in collection.find(query, indexFields[name]):
+                    self.updateIndex(name, index, item['_id'], item)
+            except Exception:
+                with self._pendingLock:
+                    self._pendingIds.pop(name, None)
+                raise
+            with self._pendingLock:
+                ids = list(self._pendingIds.pop(name))
+                self._indexes[name] = index
+
+            if ids:
+                items = dict(
+                    (i['_id'], i) for i in collection.find(
+                        {'_id': {'$in': ids}},
+                        indexFields[name] + ['folderId']
+                    )
+                )
+                for itemId in ids:
+                    item = items.get(itemId)
+                    if item is not None and item['folderId'] != folderId:
+                        item = None
+                    self.updateIndex(name, index, itemId, item)
+            return index
+
+    def getPool(self, name, size):
+        # worker pools are shared between requests so that the total number
+        # of concurrent queries issued by the plugin stays bounded
+        with self._poolLock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = ThreadPool(size)
+                self._pools[name] = pool
+        return pool
+
+    def checkAccess(self, level=AccessType.READ, priv=False, fail=True,
+                    info=None):
+        if info is None:
+            info = self.gritsInfo()
+        g = info['group']
+        p = info['groupPriv']
         user = self.getCurrentUser()
         groupModel = ModelImporter().model('group')
 
@@ -317,6 +701,15 @@ class GRITSDatabase(Resource):
                     query[itemKey]['$elemMatch'][arrayKey] = value
         return self
 
+    @staticmethod
+    def addTermToQuery(query, params, key, itemKey, useRegex):
+        value = params.get(key)
+        if value is not None:
+            if useRegex:
+                query[itemKey] = re.compile(value, re.IGNORECASE)
+            else:
+                query[itemKey] = normalizeTerm(value)
+
     @access.user
     @loadmodel(map={'id': 'item'}, model='item', level=AccessType.WRITE)
     def gritsSetPrivateMetadata(self, item, params):
@@ -355,16 +748,11 @@ class GRITSDatabase(Resource):
     )
     commonErrors(gritsSetPrivateMetadata)
 
-    @access.user
-    def gritsSearch(self, params):
-
-        folder = self.gritsFolder()
-
-        self.checkAccess()
-
-        limit, offset, sort = self.getPagingParameters(params, 'meta.date')
-        sDate = dateParse(params.get('start', '1990-01-01'))
-        eDate = dateParse(params.get('end', str(datetime.now())))
+    def buildQuery(self, params, folder):
+        # mongo compares aware dates in UTC, so normalizing keeps the
+        # meaning of the query while making the bounds comparable
+        sDate = naiveUTC(dateParse(params.get('start', '1990-01-01')))
+        eDate = naiveUTC(dateParse(params.get('end', str(datetime.now()))))
         useRegex = 'regex' in params
 
         query = {
@@ -377,27 +765,23 @@ class GRITSDatabase(Resource):
         self.addToQuery(query, params, 'species', useRegex)
         self.addToQuery(query, params, 'feed', useRegex)
         self.addToQuery(query, params, 'description', useRegex)
-        self.addToQuery(
-            query,
-            params,
-            'diagnosis',
-            useRegex,
-            'meta.diagnosis.diseases',
-            'name'
+        self.addTermToQuery(
+            query, params, 'diagnosis', 'diagnosisNames', useRegex
+        )
+        self.addTermToQuery(
+            query, params, 'diagnosisKeyword', 'diagnosisKeywords', useRegex
         )
         self.addToQuery(query, params, 'id', useRegex, 'name')
+        return query
 
+    def formatResults(self, result, params, priv):
         model = ModelImporter().model('item')
-        cursor = model.find(
-            query=query,
-            fields=None,
-            offset=offset,
-            limit=limit,
-            sort=sort
-        )
-        result = list(cursor)
-        if not self.checkAccess(priv=True, fail=False):
+        if not priv:
             result = [model.filter(i) for i in result]
+        else:
+            for i in result:
+                i.pop('diagnosisNames', None)
+                i.pop('diagnosisKeywords', None)
 
         if 'randomSymptoms' in params:
             try:
@@ -419,11 +803,506 @@ class GRITSDatabase(Resource):
             result = self.togeoJSON(result)
         return result
 
+    @staticmethod
+    def itemText(item):
+        return ' '.join((
+            item.get('description') or '',
+            item.get('meta', {}).get('description') or ''
+        ))
+
+    def getTextIndex(self, folderId):
+        # built on first use, then kept current by the item event handlers
+        index = self._indexes['text']
+        if index is None:
+            index = self.buildIndex(
+                'text', folderId, TextIndex, {'folderId': folderId}
+            )
+        return index
+
+    def runTextSearch(self, query, text, options, params, folder, priv):
+        """Return the matches of the date and field filters in decreasing
+        order of relevance.
+
+        Ranked candidates are checked against the filters in batches of
+        growing size until enough of them pass to fill the page.
+        """
+        ranked = [i for i, _ in self.getTextIndex(folder['_id']).search(text)]
+        collection = readCollection(options['readPrimary'])
+        offset = options['offset']
+        needed = offset + options['limit']
+
+        ids = []
+        start = 0
+        size = max(config['textCandidateBatch'], needed)
+        while start < len(ranked) and len(ids) < needed:
+            batch = ranked[start:start + size]
+            batchQuery = dict(query)
+            batchQuery['_id'] = {'$in': batch}
+            cursor = collection.find(batchQuery, ['_id'])
+            passed = set(
+                i['_id'] for i in cursor.max_time_ms(options['maxTimeMS'])
+            )
+            ids.extend(i for i in batch if i in passed)
+            start += size
+            size *= 2
+        ids = ids[offset:needed]
+
+        items = {
+            i['_id']: i for i in collection.find({'_id': {'$in': ids}})
+        }
+        result = [items[i] for i in ids if i in items]
+        return self.formatResults(result, params, priv)
+
+    @staticmethod
+    def suggestValues(item):
+        meta = item.get('meta', {})
+        values = {}
+        for key in ('country', 'disease', 'species', 'feed'):
+            if hasattr(meta.get(key), 'lower'):
+                values[key] = [meta[key]]
+        diseases = (meta.get('diagnosis') or {}).get('diseases') or []
+        values['diagnosis'] = list(set(
+            d['name'] for d in diseases
+            if isinstance(d, dict) and hasattr(d.get('name'), 'lower')
+        ))
+        return values
+
+    def getSuggestIndex(self, folderId):
+        # built at load when the folder exists, otherwise on first use
+        index = self._indexes['suggest']
+        if index is None:
+            index = self.buildIndex(
+                'suggest', folderId, lambda: SuggestIndex(suggestFields),
+                {'folderId': folderId}
+            )
+        return index
+
+    def getHotWindow(self, folderId):
+        """Return the in-memory window of recent incidents, or None when it
+        is disabled or numpy is not installed."""
+        if numpy is None or config['hotWindowDays'] <= 0:
+            return None
+        # built at load when the folder exists, otherwise on first use
+        window = self._indexes['hotWindow']
+        if window is None:
+            start = datetime.utcnow() - \
+                timedelta(days=config['hotWindowDays'])
+            window = self.buildIndex(
+                'hotWindow', folderId,
+                lambda: HotWindow(start, config['hotWindowMaxRows']),
+                {'folderId': folderId, 'meta.date': {'$gte': start}}
+            )
+        return window
+
+    def runHotWindowSearch(self, query, options, params, priv):
+        """Answer a date and field filtered search from the hot window.
+
+        Returns None when the query is outside of what the window holds.
+        """
+        if options['readPrimary'] or not set(query) <= hotWindowKeys:
+            return None
+        sort = options['sort']
+        if [field for field, _ in sort] != ['meta.date', '_id'] or \
+                sort[0][1] != sort[1][1]:
+            return None
+        window = self.getHotWindow(query['folderId'])
+        if window is None:
+            return None
+
+        ids = window.query(
+            query['meta.date']['$gte'],
+            query['meta.date']['$lt'],
+            dict((f, query['meta.' + f])
+                 for f in HotWindow.fields if 'meta.' + f in query),
+            sort[0][1] < 0,
+            options['offset'],
+            options['limit']
+        )
+        if ids is None:
+            return None
+
+        # the window follows this process' writes, so the items that a
+        # secondary has not seen yet are read from the primary
+        items = dict(
+            (i['_id'], i) for i in readCollection(options['readPrimary'])
+            .find({'_id': {'$in': ids}})
+        )
+        missing = [i for i in ids if i not in items]
+        if missing:
+            items.update(
+                (i['_id'], i) for i in readCollection(primary=True)
+                .find({'_id': {'$in': missing}})
+            )
+        result = [items[i] for i in ids if i in items]
+        return self.formatResults(result, params, priv)
+
+    @staticmethod
+    def parseFacets(params):
+        facets = params.get('facets')
+        if not facets:
+            return []
+        if not isinstance(facets, list):
+            facets = facets.split(',')
+        facets = [f.strip() for f in facets if f.strip()]
+        for f in facets:
+            if f not in facetFields:
+                raise RestException(
+                    'Invalid facet "%s", expected one of: %s' %
+                    (f, ', '.join(sorted(facetFields)))
+                )
+        return facets
+
+    def runFacetedSearch(self, query, facets, options, params, priv):
+        facetLimit = getIntParam(params, 'facetLimit', config['facetLimit'])
+        if facetLimit <= 0:
+            raise RestException('facetLimit must be positive.')
+
+        # only the counts go through $facet, whose output is a single
+        # document; the page is read with a normal cursor
+        stages = {}
+        for f in facets:
+            stages[f] = [
+                {'$group': {
+                    '_id': '$' + facetFields[f],
+                    'count': {'$sum': 1}
+                }},
+                {'$sort': SON([('count', -1), ('_id', 1)])},
+                {'$limit': facetLimit}
+            ]
+
+        output = aggregate(
+            readCollection(options['readPrimary']),
+            [{'$match': query}, {'$facet': stages}],
+            maxTimeMS=options['maxTimeMS']
+        )[0]
+
+        return {
+            'results': self.formatResults(
+                self.findPage(query, options), params, priv
+            ),
+            'facets': {
+                f: [
+                    {'value': r['_id'], 'count': r['count']}
+                    for r in output[f] if r['_id'] is not None
+                ]
+                for f in facets
+            }
+        }
+
+    def runSampledSearch(self, query, options, params, priv):
+        size = getIntParam(params, 'sample')
+        if size <= 0 or size > options['maxLimit']:
+            raise RestException(
+                'sample must be between 1 and %d.' % options['maxLimit']
+            )
+
+        collection = readCollection(options['readPrimary'])
+        # only the ids pass through $sample, the documents are fetched after
+        ids = [doc['_id'] for doc in aggregate(
+            collection,
+            [{'$match': query},
+             {'$project': {'_id': 1}},
+             {'$sample': {'size': size}}],
+            maxTimeMS=options['maxTimeMS']
+        )]
+        docs = dict(
+            (doc['_id'], doc) for doc in collection.find(
+                {'_id': {'$in': ids}}
+            ).max_time_ms(options['maxTimeMS'])
+        )
+        results = [docs[i] for i in ids if i in docs]
+
+        output = {'results': self.formatResults(results, params, priv)}
+        output.update(self.countMatches(collection, query, options))
+        return output
+
+    @staticmethod
+    def countMatches(collection, query, options):
+        """Count the incidents matching ``query``.
+
+        Queries on the folder and date alone are counted from the index.
+        Other queries are counted within ``maxTimeMS``; when that times out
+        the index count of the folder and date range is returned as an
+        upper bound with ``totalEstimated`` set.
+        """
+        indexed = dict(
+            (k, v) for k, v in query.items() if k in ('folderId', 'meta.date')
+        )
+        if len(indexed) == len(query):
+            return {'total': countDocuments(collection, query)}
+        try:
+            return {'total': countDocuments(
+                collection, query, maxTimeMS=options['maxTimeMS']
+            )}
+        except ExecutionTimeout:
+            return {
+                'total': countDocuments(collection, indexed),
+                'totalEstimated': True
+            }
+
+    def planPartitions(self, query, partitions, options):
+        """Split the date range of ``query`` into up to ``partitions``
+        ranges holding roughly the same number of incidents.
+
+        The density is estimated from index-only counts of the folder over
+        ``partitionOversample`` times as many equal width slices.
+        """
+        start = query['meta.date']['$gte']
+        end = query['meta.date']['$lt']
+        nSlices = partitions * config['partitionOversample']
+        width = (end - start) // nSlices
+        if width <= timedelta(0):
+            return [(start, end)]
+        bounds = [start + width * i for i in range(nSlices)] + [end]
+
+        collection = readCollection(options['readPrimary'])
+
+        def count(i):
+            return countDocuments(collection, {
+                'folderId': query['folderId'],
+                'meta.date': {'$gte': bounds[i], '$lt': bounds[i + 1]}
+            })
+
+        pool = self.getPool('partition', config['partitionThreads'])
+        counts = pool.map(count, range(nSlices))
+        return splitRange(bounds, counts, partitions)
+
+    def runPartitionedSearch(self, query, options, params, priv):
+        partitions = getIntParam(params, 'partitions')
+        if partitions <= 0 or partitions > config['maxPartitions']:
+            raise RestException(
+                'partitions must be between 1 and %d.' %
+                config['maxPartitions']
+            )
+        ranges = self.planPartitions(query, partitions, options)
+
+        collection = readCollection(options['readPrimary'])
+        offset = options['offset']
+        limit = options['limit']
+
+        def run(dateRange):
+            partitionQuery = dict(query)
+            partitionQuery['meta.date'] = {
+                '$gte': dateRange[0], '$lt': dateRange[1]
+            }
+            cursor = collection.find(
+                partitionQuery,
+                limit=offset + limit,
+                sort=options['sort']
+            ).max_time_ms(options['maxTimeMS'])
+            return list(cursor)
+
+        pool = self.getPool('partition', config['partitionThreads'])
+        sort = options['sort']
+        if sort[0][0] == 'meta.date':
+            # the partitions are disjoint date ranges, so their pages are
+            # concatenated in date order as they complete, stopping as soon
+            # as the page is filled
+            if sort[0][1] < 0:
+                ranges = ranges[::-1]
+            result = []
+            for docs in pool.imap(run, ranges):
+                result.extend(docs)
+                if len(result) >= offset + limit:
+                    break
+            return self.formatResults(
+                result[offset:offset + limit], params, priv
+            )
+
+        merged = mergeSorted(pool.map(run, ranges), options['sort'])
+        result = list(itertools.islice(merged, offset, offset + limit))
+        return self.formatResults(result, params, priv)
+
+    def getSearchOptions(self, params, priv):
+        """Return the paging and execution options of a search, bounded by the
+        limits of the caller's access tier."""
+        tier = 'priv' if priv else 'user'
+        limit, offset, sort = self.getPagingParameters(params, 'meta.date')
+        # break ties by id so that pages are stable across every strategy
+        if all(field != '_id' for field, _ in sort):
+            sort = list(sort) + [('_id', sort[-1][1])]
+        maxLimit = config['maxLimit'][tier]
+        if limit <= 0 or limit > maxLimit:
+            limit = maxLimit
+        maxTimeMS = config['maxTimeMS'][tier]
+        if params.get('maxTimeMS'):
+            maxTimeMS = max(
+                1, min(getIntParam(params, 'maxTimeMS'), maxTimeMS)
+            )
+        return {
+            'limit': limit,
+            'maxLimit': maxLimit,
+            'offset': offset,
+            'sort': sort,
+            'maxTimeMS': maxTimeMS,
+            # only privileged users edit incidents and need to read back
+            # their own writes
+            'readPrimary': priv and 'readPrimary' in params
+        }
+
+    def runSearch(self, params, folder, priv):
+        """Run a search for an already authorized user.
+
+        The caller is responsible for the access checks; ``priv`` selects
+        whether private metadata is returned.
+        """
+        options = self.getSearchOptions(params, priv)
+        query = self.buildQuery(params, folder)
+
+        gated = not params.get('text') and isExpensiveQuery(query)
+        if gated and not self._expensiveGate.acquire(
+                config['expensiveQueueTimeout']):
+            raise RestException(
+                'Too many expensive searches are running; narrow the date ' +
+                'range, anchor the regular expressions with ^ or retry ' +
+                'later.',
+                code=503
+            )
+        try:
+            return self.executeSearch(query, options, params, folder, priv)
+        except ExecutionTimeout:
+            raise RestException(
+                'The search exceeded its time budget of %d ms; narrow the '
+                'date range or the field filters.' % options['maxTimeMS'],
+                code=503
+            )
+        finally:
+            if gated:
+                self._expensiveGate.release()
+
+    @staticmethod
+    def findPage(query, options):
+        cursor = readCollection(options['readPrimary']).find(
+            query,
+            skip=options['offset'],
+            limit=options['limit'],
+            sort=options['sort']
+        ).max_time_ms(options['maxTimeMS'])
+        return list(cursor)
+
+    def executeSearch(self, query, options, params, folder, priv):
+        facets = self.parseFacets(params)
+        text = params.get('text')
+        modes = [m for m in ('text', 'facets', 'sample') if params.get(m)]
+        if len(modes) > 1:
+            raise RestException(
+                'The %s parameters cannot be combined.' % ' and '.join(modes)
+            )
+
+        if text:
+            return self.runTextSearch(
+                query, text, options, params, folder, priv
+            )
+
+        if params.get('sample'):
+            return self.runSampledSearch(query, options, params, priv)
+
+        if facets:
+            return self.runFacetedSearch(
+                query, facets, options, params, priv
+            )
+
+        result = self.runHotWindowSearch(query, options, params, priv)
+        if result is not None:
+            return result
+
+        if params.get('partitions'):
+            return self.runPartitionedSearch(query, options, params, priv)
+
+        return self.formatResults(
+            self.findPage(query, options), params, priv
+        )
+
+    @staticmethod
+    def acceptedEncoding():
+        return negotiateEncoding(
+            cherrypy.request.headers.get('Accept-Encoding')
+        )
+
+    @staticmethod
+    def cachedResponse(data, encoding):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Content-Encoding'] = encoding
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+
+        def stream():
+            yield data
+        return stream
+
+    def encodedResponse(self, result, encoding, cacheKey=None,
+                        generation=None):
+        """Stream ``result`` as JSON, compressed with ``encoding`` when it is
+        larger than the compression threshold.
+
+        The body is serialized and compressed incrementally; only the first
+        compressionThreshold bytes are buffered to choose the encoding.
+        When ``cacheKey`` is given the compressed body is cached once it has
+        been sent, unless the cache was cleared since ``generation``.
+        """
+        # encoded as girder encodes the responses it serializes itself
+        encoder = JsonEncoder(sort_keys=True, allow_nan=False)
+        chunks = (toBytes(c) for c in encoder.iterencode(result))
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= config['compressionThreshold']:
+                break
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if size < config['compressionThreshold']:
+            def stream():
+                yield b''.join(head)
+            return stream
+
+        cherrypy.response.headers['Content-Encoding'] = encoding
+
+        def stream():
+            compressed = []
+            for data in compressChunks(itertools.chain(head, chunks),
+                                       encoding, config['compressionLevel']):
+                if cacheKey is not None:
+                    compressed.append(data)
+                yield data
+            if cacheKey is not None:
+                self._responseCache.put(
+                    cacheKey, b''.join(compressed), generation
+                )
+        return stream
+
+    @access.user
+    def gritsSearch(self, params):
+        info = self.gritsInfo()
+        self.checkAccess(info=info)
+        priv = self.checkAccess(priv=True, fail=False, info=info)
+
+        encoding = self.acceptedEncoding()
+        if encoding is None:
+            return self.runSearch(params, info['folder'], priv)
+
+        cacheKey = None
+        # taken before searching so that a response computed across an item
+        # update is not cached
+        generation = self._responseCache.generation
+        # random samples and read-your-writes requests must not be cached
+        if not params.get('sample') and 'readPrimary' not in params:
+            cacheKey = (priv, encoding, json.dumps(params, sort_keys=True))
+            data = self._responseCache.get(cacheKey)
+            if data is not None:
+                return self.cachedResponse(data, encoding)
+
+        result = self.runSearch(params, info['folder'], priv)
+        return self.encodedResponse(result, encoding, cacheKey, generation)
+
     gritsSearch.description = (
         Description("Perform a query on the GRITS incident database.")
         .notes(
             "The country, disease, species, feed, and " +
-            "description parameters accept regular expressions."
+            "description parameters accept regular expressions.  " +
+            "Responses larger than a threshold are compressed with gzip " +
+            "or deflate according to the Accept-Encoding header."
         )
         .param(
             "start",
@@ -462,7 +1341,14 @@ class GRITSDatabase(Resource):
         )
         .param(
             "diagnosis",
-            "Match disease names in the differential diagnosis of the report",
+            "Match disease names in the differential diagnosis of the " +
+            "report (case insensitive)",
+            required=False
+        )
+        .param(
+            "diagnosisKeyword",
+            "Match keywords of the diseases in the differential diagnosis " +
+            "of the report (case insensitive)",
             required=False
         )
         .param(
@@ -470,9 +1356,16 @@ class GRITSDatabase(Resource):
             "Match by internal incident identification number",
             required=False
         )
+        .param(
+            "text",
+            "Ranked full text search over the summary and description of " +
+            "the incident.  Results are returned by decreasing relevance",
+            required=False
+        )
         .param(
             "limit",
-            "The number of items to return (default=50)",
+            "The number of items to return (default=50).  The limit is " +
+            "capped according to the access level of the user",
             required=False,
             dataType='int'
         )
@@ -482,6 +1375,20 @@ class GRITSDatabase(Resource):
             required=False,
             dataType='int'
         )
+        .param(
+            "maxTimeMS",
+            "The time budget of the query in milliseconds, capped " +
+            "according to the access level of the user",
+            required=False,
+            dataType='int'
+        )
+        .param(
+            "readPrimary",
+            "Read from the primary of the replica set instead of the " +
+            "configured read preference (privileged users only)",
+            required=False,
+            dataType='bool'
+        )
         .param(
             "geoJSON",
             "Return the query as a geoJSON object " +
@@ -495,14 +1402,164 @@ class GRITSDatabase(Resource):
             required=False,
             dataType='bool'
         )
+        .param(
+            "facets",
+            "A comma separated list of fields (country, disease, feed, " +
+            "species) to count over the whole query.  When present the " +
+            "response is an object with 'results' and 'facets' keys",
+            required=False
+        )
+        .param(
+            "sample",
+            "Return this many incidents chosen uniformly at random from " +
+            "the matches instead of a page.  The response is an object " +
+            "with 'results' and 'total' keys.  When the matches cannot " +
+            "be counted in time 'total' is an upper bound and " +
+            "'totalEstimated' is true",
+            required=False,
+            dataType='int'
+        )
+        .param(
+            "partitions",
+            "Split the date range into this many partitions of similar " +
+            "size and query them concurrently (default=1)",
+            required=False,
+            dataType='int'
+        )
+        .param(
+            "facetLimit",
+            "The number of values to return for each facet (default=10)",
+            required=False,
+            dataType='int'
+        )
         .errorResponse()
+        .errorResponse('The search was too expensive to run now.', 503)
     )
     commonErrors(gritsSearch)
 
+    @access.user
+    def gritsBatchSearch(self, params):
+        info = self.gritsInfo()
+        self.checkAccess(info=info)
+        priv = self.checkAccess(priv=True, fail=False, info=info)
+
+        try:
+            specs = json.loads(cherrypy.request.body.read())
+        except ValueError:
+            raise RestException('Invalid JSON passed in request body.')
+
+        if not isinstance(specs, list) or \
+                not all(isinstance(s, dict) for s in specs):
+            raise RestException(
+                'Request body must be a list of search parameter objects.'
+            )
+        if len(specs) > config['batchMaxQueries']:
+            raise RestException(
+                'At most %d searches are allowed in one batch.' %
+                config['batchMaxQueries']
+            )
+
+        folder = info['folder']
+
+        def run(spec):
+            try:
+                return {'result': self.runSearch(spec, folder, priv)}
+            except RestException as e:
+                return {'error': e.message, 'code': e.code}
+            except (ValueError, TypeError) as e:
+                return {'error': str(e), 'code': 400}
+            except Exception as e:
+                return {'error': str(e), 'code': 500}
+
+        if not specs:
+            return []
+        pool = self.getPool('batch', config['batchThreads'])
+        results = pool.map(run, specs)
+
+        encoding = self.acceptedEncoding()
+        if encoding is None:
+            return results
+        return self.encodedResponse(results, encoding)
+    gritsBatchSearch.description = (
+        Description("Perform several queries on the GRITS incident database.")
+        .notes(
+            "The body is a JSON list of objects, each accepting the same " +
+            "parameters as the GET search.  The response is a list in the " +
+            "same order containing either a 'result' or an 'error' and " +
+            "'code' for each query."
+        )
+        .param(
+            'body',
+            'A JSON list of search parameter objects',
+            paramType='body'
+        )
+        .errorResponse()
+    )
+    commonErrors(gritsBatchSearch)
+
+    @access.user
+    def gritsSuggest(self, params):
+        info = self.gritsInfo()
+        self.checkAccess(info=info)
+        self.requireParams(('field', 'prefix'), params)
+
+        field = params['field']
+        if field not in suggestFields:
+            raise RestException(
+                'Invalid field "%s", expected one of: %s' %
+                (field, ', '.join(sorted(suggestFields)))
+            )
+        limit = getIntParam(params, 'limit', 10)
+
+        index = self.getSuggestIndex(info['folder']['_id'])
+        return [
+            {'value': value, 'count': count}
+            for value, count in index.suggest(field, params['prefix'], limit)
+        ]
+    gritsSuggest.description = (
+        Description("Suggest values of an incident field from a prefix.")
+        .notes(
+            "Matching is case insensitive and the most frequent values " +
+            "are returned first."
+        )
+        .param(
+            "field",
+            "One of country, disease, species, feed or diagnosis"
+        )
+        .param(
+            "prefix",
+            "The beginning of the value"
+        )
+        .param(
+            "limit",
+            "The number of suggestions to return (default=10)",
+            required=False,
+            dataType='int'
+        )
+        .errorResponse()
+    )
+    commonErrors(gritsSuggest)
+
 
 def load(info):
     db = GRITSDatabase()
+    events.bind('model.item.save', 'gritsSearch', db.onItemBeforeSave)
+    events.bind('model.item.save.after', 'gritsSearch', db.onItemSave)
+    events.bind('model.item.remove', 'gritsSearch', db.onItemRemove)
+
+    db.warmUp()
+
     info['apiRoot'].resource.route('GET', ('grits',), db.gritsSearch)
+    info['apiRoot'].resource.route(
+        'POST',
+        ('grits', 'batch'),
+        db.gritsBatchSearch
+    )
+    info['apiRoot'].resource.route(
+        'GET',
+        ('grits', 'suggest'),
+        db.gritsSuggest
+    )
     info['apiRoot'].resource.route(
         'GET',
         ('grits', 'folderId'),
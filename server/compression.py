@@ -0,0 +1,101 @@
+import collections
+import threading
+import time
+import zlib
+
+# window bits selecting the container format of each content coding
+encodings = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+
+def negotiateEncoding(acceptEncoding):
+    """Pick the content coding preferred by an Accept-Encoding header.
+
+    Returns None when neither gzip nor deflate is acceptable.
+    """
+    best = None
+    bestQ = 0.0
+    for part in (acceptEncoding or '').split(','):
+        fields = part.strip().split(';')
+        name = fields[0].strip().lower()
+        q = 1.0
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith('q='):
+                try:
+                    q = float(field[2:])
+                except ValueError:
+                    q = 0.0
+        if name == '*':
+            name = 'gzip'
+        if name in encodings and q > bestQ:
+            best = name
+            bestQ = q
+    return best
+
+
+def toBytes(chunk):
+    if not isinstance(chunk, bytes):
+        chunk = chunk.encode('utf8')
+    return chunk
+
+
+def compressChunks(chunks, encoding, level):
+    """Compress an iterable of byte strings incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, encodings[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class ResponseCache(object):
+    """A least recently used cache of encoded responses with a time to live
+    and a bound on the total number of bytes held.
+
+    Each ``clear`` starts a new generation.  A response computed before a
+    clear is dropped when it is put with the generation it started in.
+    """
+
+    def __init__(self, maxBytes, ttl):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] + self.ttl < time.time():
+                self._size -= len(entry[1])
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def put(self, key, data, generation=None):
+        if len(data) > self.maxBytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[key] = (time.time(), data)
+            self._size += len(data)
+            while self._size > self.maxBytes:
+                _, entry = self._entries.popitem(last=False)
+                self._size -= len(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.generation += 1
@@ -0,0 +1,188 @@
+import threading
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+epoch = datetime(1970, 1, 1)
+
+
+def naiveUTC(date):
+    """Convert an aware datetime to the naive UTC form mongo returns."""
+    if date.tzinfo is None:
+        return date
+    return (date - date.utcoffset()).replace(tzinfo=None)
+
+
+def toMicros(date):
+    delta = date - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class HotWindow(object):
+    """A columnar in-memory copy of the incidents dated after ``start``.
+
+    Dates, ids and dictionary encoded field values are kept in numpy
+    arrays so that date range and field filters are evaluated with
+    vectorized comparisons.  Updated and removed rows are tombstoned and
+    compacted away in bulk.  When more than ``maxRows`` incidents are held
+    the oldest ones are evicted and ``start`` moves forward.
+    """
+
+    fields = ('country', 'disease', 'feed', 'species')
+
+    def __init__(self, start, maxRows):
+        self.start = start
+        self.maxRows = maxRows
+        self._lock = threading.Lock()
+        self._size = 0
+        self._dead = 0
+        self._allocate(1024)
+        self._ids = []
+        self._rows = {}
+        self._dictionaries = [{} for f in self.fields]
+        # documents whose fields cannot be dictionary encoded; while there
+        # are any the window cannot answer queries
+        self._irregular = set()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _allocate(self, capacity):
+        self._dates = numpy.empty(capacity, dtype=numpy.int64)
+        # the 12 bytes of the object ids, which order like the ids
+        self._keys = numpy.empty(capacity, dtype='S12')
+        self._codes = [
+            numpy.empty(capacity, dtype=numpy.int32) for f in self.fields
+        ]
+        self._live = numpy.zeros(capacity, dtype=bool)
+
+    def _columns(self):
+        return [self._dates, self._keys, self._live] + self._codes
+
+    def _resize(self, rows, capacity):
+        """Keep the given rows, in order, in arrays of a new capacity."""
+        old = self._columns()
+        self._allocate(capacity)
+        for new, column in zip(self._columns(), old):
+            new[:len(rows)] = column[rows]
+        self._ids = [self._ids[r] for r in rows]
+        self._rows = dict((docId, i) for i, docId in enumerate(self._ids))
+        self._size = len(rows)
+        self._dead = 0
+
+    def _compact(self):
+        rows = numpy.flatnonzero(self._live[:self._size])
+        self._resize(rows, max(1024, 2 * len(rows)))
+
+    def _evict(self):
+        # evict down to 90% of the bound so that eviction is amortized
+        live = numpy.flatnonzero(self._live[:self._size])
+        dates = numpy.sort(self._dates[live])
+        threshold = int(dates[-int(self.maxRows * 0.9)])
+        self.start = max(
+            self.start, epoch + timedelta(microseconds=threshold)
+        )
+        for row in live[self._dates[live] < threshold]:
+            del self._rows[self._ids[row]]
+            self._live[row] = False
+        self._compact()
+
+    def _encode(self, i, value):
+        dictionary = self._dictionaries[i]
+        code = dictionary.get(value)
+        if code is None:
+            code = dictionary[value] = len(dictionary)
+        return code
+
+    def _remove(self, docId):
+        self._irregular.discard(docId)
+        row = self._rows.pop(docId, None)
+        if row is None:
+            return
+        self._live[row] = False
+        self._dead += 1
+        if self._dead > 1024 and self._dead * 2 > self._size:
+            self._compact()
+
+    def add(self, docId, meta):
+        """Insert or replace the incident ``docId`` from its metadata."""
+        with self._lock:
+            self._remove(docId)
+            date = meta.get('date')
+            if not isinstance(date, datetime):
+                return
+            # mongo stores aware dates in UTC and returns them naive
+            date = naiveUTC(date)
+            if date < self.start:
+                return
+
+            codes = []
+            for i, field in enumerate(self.fields):
+                value = meta.get(field)
+                if value is None:
+                    codes.append(-1)
+                elif hasattr(value, 'lower'):
+                    codes.append(self._encode(i, value))
+                else:
+                    self._irregular.add(docId)
+                    return
+
+            if self._size == len(self._dates):
+                self._resize(numpy.arange(self._size), 2 * self._size)
+            row = self._size
+            self._dates[row] = toMicros(date)
+            self._keys[row] = docId.binary
+            for column, code in zip(self._codes, codes):
+                column[row] = code
+            self._live[row] = True
+            self._ids.append(docId)
+            self._rows[docId] = row
+            self._size += 1
+
+            if len(self._rows) > self.maxRows:
+                self._evict()
+
+    def remove(self, docId):
+        with self._lock:
+            self._remove(docId)
+
+    def query(self, start, end, filters, descending, offset, limit):
+        """Return the ids of the incidents in ``[start, end)`` matching the
+        filters, sorted by date then id, or None if the window cannot
+        answer.
+
+        ``filters`` maps field names to a value matched exactly or to a
+        compiled regular expression.
+        """
+        if start.tzinfo is not None or end.tzinfo is not None:
+            return None
+        with self._lock:
+            if self._irregular or start < self.start:
+                return None
+            n = self._size
+            dates = self._dates[:n]
+            mask = self._live[:n] & (dates >= toMicros(start)) & \
+                (dates < toMicros(end))
+            for i, field in enumerate(self.fields):
+                if field not in filters:
+                    continue
+                value = filters[field]
+                dictionary = self._dictionaries[i]
+                if hasattr(value, 'pattern'):
+                    codes = [
+                        c for v, c in dictionary.items() if value.search(v)
+                    ]
+                    mask &= numpy.isin(self._codes[i][:n], codes)
+                else:
+                    code = dictionary.get(value)
+                    if code is None:
+                        return []
+                    mask &= self._codes[i][:n] == code
+            rows = numpy.flatnonzero(mask)
+            rows = rows[numpy.lexsort((self._keys[rows], dates[rows]))]
+            if descending:
+                rows = rows[::-1]
+            return [self._ids[r] for r in rows[offset:offset + limit]]
@@ -0,0 +1,71 @@
+import heapq
+import itertools
+
+
+def getField(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class SortKey(object):
+    """Orders documents like a mongo sort specification.
+
+    Missing values sort before any other value as they do in mongo.
+    """
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, doc, sort):
+        self.values = [
+            (0,) if v is None else (1, v)
+            for v in (getField(doc, field) for field, _ in sort)
+        ]
+        self.directions = [direction for _, direction in sort]
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return self.values != other.values
+
+    def __lt__(self, other):
+        for a, b, direction in zip(self.values, other.values,
+                                   self.directions):
+            if a != b:
+                return a < b if direction > 0 else a > b
+        return False
+
+
+def mergeSorted(lists, sort):
+    """Merge lists of documents, each already sorted by ``sort``, into one
+    sorted iterator.  Ties keep the order of the lists."""
+    decorated = [
+        ((SortKey(doc, sort), i, j, doc) for j, doc in enumerate(docs))
+        for i, docs in enumerate(lists)
+    ]
+    return (entry[3] for entry in heapq.merge(*decorated))
+
+
+def splitRange(bounds, counts, partitions):
+    """Group consecutive slices into at most ``partitions`` ranges holding
+    roughly the same count.
+
+    ``bounds`` are the ``len(counts) + 1`` edges of the slices and the
+    result is a list of ``(lower, upper)`` pairs covering all of them.
+    """
+    total = sum(counts)
+    if total == 0 or partitions <= 1:
+        return [(bounds[0], bounds[-1])]
+    ranges = []
+    lower = bounds[0]
+    cumulative = 0
+    for i, count in enumerate(itertools.islice(counts, len(counts) - 1)):
+        cumulative += count
+        if len(ranges) < partitions - 1 and \
+                cumulative * partitions >= total * (len(ranges) + 1):
+            ranges.append((lower, bounds[i + 1]))
+            lower = bounds[i + 1]
+    ranges.append((lower, bounds[-1]))
+    return ranges
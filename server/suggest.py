@@ -0,0 +1,88 @@
+import bisect
+import heapq
+import threading
+
+
+class PrefixIndex(object):
+    """A sorted array of distinct values with their frequencies.
+
+    Values are matched case insensitively by prefix using binary search.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, value, count=1):
+        if value in self._counts:
+            self._counts[value] += count
+        else:
+            self._counts[value] = count
+            bisect.insort(self._keys, (value.lower(), value))
+
+    def discard(self, value, count=1):
+        current = self._counts.get(value)
+        if current is None:
+            return
+        if current > count:
+            self._counts[value] = current - count
+            return
+        del self._counts[value]
+        key = (value.lower(), value)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def suggest(self, prefix, limit=10):
+        """Return up to ``limit`` ``(value, count)`` pairs starting with
+        ``prefix``, most frequent first."""
+        prefix = prefix.lower()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        matches = []
+        while i < len(self._keys) and self._keys[i][0].startswith(prefix):
+            matches.append(self._keys[i][1])
+            i += 1
+        top = heapq.nlargest(limit, matches, key=lambda v: self._counts[v])
+        return [(v, self._counts[v]) for v in top]
+
+
+class SuggestIndex(object):
+    """Prefix indexes for several fields, updated one document at a time.
+
+    The values contributed by each document are remembered so that a
+    document can be updated or removed without rescanning the collection.
+    """
+
+    def __init__(self, fields):
+        self._indexes = dict((f, PrefixIndex()) for f in fields)
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, docId):
+        for field, values in self._docs.pop(docId, {}).items():
+            for value in values:
+                self._indexes[field].discard(value)
+
+    def update(self, docId, values):
+        """Replace the values of a document, given as a dict of lists."""
+        values = dict(
+            (f, v) for f, v in values.items() if f in self._indexes and v
+        )
+        with self._lock:
+            self._remove(docId)
+            for field, fieldValues in values.items():
+                for value in fieldValues:
+                    self._indexes[field].add(value)
+            if values:
+                self._docs[docId] = values
+
+    def remove(self, docId):
+        with self._lock:
+            self._remove(docId)
+
+    def suggest(self, field, prefix, limit=10):
+        with self._lock:
+            return self._indexes[field].suggest(prefix, limit)
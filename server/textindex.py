@@ -0,0 +1,99 @@
+import math
+import re
+import threading
+
+_tokenPattern = re.compile(r'\w+', re.UNICODE)
+
+
+def stem(word):
+    """Strip common English inflections (a light Porter step 1)."""
+    if len(word) <= 3:
+        return word
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith('ies'):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [stem(t) for t in _tokenPattern.findall(text.lower())]
+
+
+class TextIndex(object):
+    """An in-memory inverted index ranking documents with Okapi BM25."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._docs = {}
+        self._lengths = {}
+        self._totalLength = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _remove(self, docId):
+        terms = self._docs.pop(docId, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self._postings[term]
+            del posting[docId]
+            if not posting:
+                del self._postings[term]
+        self._totalLength -= self._lengths.pop(docId)
+
+    def add(self, docId, text):
+        terms = {}
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + 1
+        with self._lock:
+            self._remove(docId)
+            if not terms:
+                return
+            self._docs[docId] = terms
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[docId] = tf
+            self._lengths[docId] = sum(terms.values())
+            self._totalLength += self._lengths[docId]
+
+    def remove(self, docId):
+        with self._lock:
+            self._remove(docId)
+
+    def search(self, text, limit=None):
+        """Return a list of ``(docId, score)`` sorted by decreasing score."""
+        terms = set(tokenize(text))
+        scores = {}
+        with self._lock:
+            nDocs = len(self._docs)
+            if not nDocs:
+                return []
+            avgLength = float(self._totalLength) / nDocs
+            for term in terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1.0 + (nDocs - df + 0.5) / (df + 0.5))
+                for docId, tf in posting.items():
+                    norm = self.k1 * (
+                        1.0 - self.b +
+                        self.b * self._lengths[docId] / avgLength
+                    )
+                    scores[docId] = scores.get(docId, 0.0) + \
+                        idf * tf * (self.k1 + 1.0) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda s: (-s[1], s[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return ranked